@@ -1,44 +1,156 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import functools
+import hashlib
+import json
 import os
 import re
+import tempfile
+import time
 import yaml
 from pathlib import Path
-from openai import OpenAI
+from openai import AsyncOpenAI, RateLimitError
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+# Use the libyaml-backed loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+# Seconds to wait between Batch API status checks
+BATCH_POLL_INTERVAL = 30
+
+# Seconds to wait for a batch before cancelling it and falling back to direct calls
+BATCH_TIMEOUT = int(os.environ.get("BATCH_TIMEOUT", str(4 * 60 * 60)))
+
+# Maximum number of concurrent chat completion requests in --sync mode
+OPENAI_CONCURRENCY = int(os.environ.get("OPENAI_CONCURRENCY", "8"))
+
+# Directory holding cached GPT classifications, keyed by request hash
+CACHE_DIR = Path('.semantic_cache')
+
+# Bump whenever the prompt, guidelines or response handling change
+PROMPT_VERSION = "2"
+
+# GPT model tried first, and the model used to re-classify uncertain results
+DEFAULT_GPT_MODEL = "gpt-4o-mini"
+ESCALATION_GPT_MODEL = "gpt-4o"
+
+# Per-directory record of input fingerprints, stored next to the semantic views
+MANIFEST_NAME = '.semantic_manifest.json'
+
+# Maximum number of SQL characters embedded in the classification prompt
+MAX_SQL_CHARS = 2000
+
+# Small models are classified together, up to this many per GPT call
+MODELS_PER_PROMPT = 5
+
+# Approximate prompt size limit, in characters, for a combined classification call
+PROMPT_CHAR_BUDGET = 20000
+
+# Matches versioned semantic view files like: model_semantic_view_v2.sql
+_VERSION_RE = re.compile(r'_v(\d+)\.sql$')
+
+# Matches a plain, unquoted SQL column name
+_IDENTIFIER_RE = re.compile(r'[a-z_][\w$]*')
+
+def _final_select_list(content):
+    """Return the items of the last top-level SELECT ... FROM in a SQL model.
+
+    Scans the text once, tracking parenthesis depth so that CTE bodies,
+    subqueries and function arguments are skipped. SQL and Jinja comments
+    and quoted strings are ignored. Items are split on top-level commas only.
+    """
+    text = content.lower()
+    if 'select' not in text:
+        return []
+
+    n = len(text)
+    depth = 0
+    items = None  # items of the SELECT currently being scanned
+    parts = []    # fragments of the current item, excluding comments
+    start = 0     # start of the current fragment
+    result = []
+    i = 0
+    while i < n:
+        ch = text[i]
+        if ((ch == '-' and text.startswith('--', i)) or (ch == '/' and text.startswith('/*', i))
+                or (ch == '{' and text.startswith('{#', i))):
+            if ch == '-':
+                end = text.find('\n', i)
+                end = n if end == -1 else end
+            else:
+                # Block comments: SQL /* ... */ and Jinja {# ... #}
+                end = text.find('*/' if ch == '/' else '#}', i + 2)
+                end = n if end == -1 else end + 2
+            if items is not None:
+                parts.append(content[start:i])
+                start = end
+            i = end
+            continue
+        if ch == "'" or ch == '"':
+            end = text.find(ch, i + 1)
+            i = n if end == -1 else end + 1
+            continue
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth = max(depth - 1, 0)
+        elif ch == ',' and depth == 0 and items is not None:
+            parts.append(content[start:i])
+            items.append(''.join(parts))
+            parts = []
+            start = i + 1
+        elif ch.isalpha() or ch == '_':
+            end = i + 1
+            while end < n and (text[end].isalnum() or text[end] in '_$'):
+                end += 1
+            if depth == 0:
+                word = text[i:end]
+                if word == 'select':
+                    items = []
+                    parts = []
+                    start = end
+                elif word == 'from' and items is not None:
+                    parts.append(content[start:i])
+                    items.append(''.join(parts))
+                    result = items
+                    items = None
+            i = end
+            continue
+        i += 1
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    return result
 
 def parse_sql_file(file_path):
     """Parse SQL file and extract column information."""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-
-    select_pattern = r'select\s+(.*?)\s+from\s+.*?(?:left\s+join|inner\s+join|$)'
-    matches = re.findall(select_pattern, content, re.IGNORECASE | re.DOTALL)
+    content = Path(file_path).read_text(encoding='utf-8')
 
     columns = []
-    if matches:
-
-        final_select = matches[-1]
-        for line in final_select.split(','):
-            line = line.strip()
-            if ' as ' in line.lower():
-                col_name = line.lower().split(' as ')[-1].strip()
-            else:
-                col_name = line.split('.')[-1].strip()
+    for line in _final_select_list(content):
+        line = line.strip()
+        line_lc = line.lower()
+        alias_pos = line_lc.rfind(' as ')
+        if alias_pos != -1:
+            col_name = line_lc[alias_pos + 4:].strip()
+        else:
+            col_name = line.split('.')[-1].strip()
 
-            col_name = col_name.replace('"', '').replace("'", '')
-            if col_name and not col_name.startswith('--'):
-                columns.append(col_name)
+        col_name = col_name.replace('"', '').replace("'", '')
+        if col_name and not col_name.startswith('--'):
+            columns.append(col_name)
 
     return columns, content
 
-def parse_model_yml(yml_path):
-    """Parse model YML file to get column descriptions."""
-    if not yml_path.exists():
-        return {}
-
-    with open(yml_path, 'r', encoding='utf-8') as f:
-        config = yaml.safe_load(f)
+@functools.lru_cache(maxsize=128)
+def _parse_yml_cached(path_str, mtime_ns):
+    """Parse a model YML file; cached per path and modification time."""
+    with open(path_str, 'r', encoding='utf-8') as f:
+        config = yaml.load(f, Loader=_YamlLoader)
 
     column_descriptions = {}
     if config and 'models' in config:
@@ -52,15 +164,56 @@ def parse_model_yml(yml_path):
 
     return column_descriptions
 
-def classify_columns_with_gpt(columns, sql_content, source_model_name, column_descriptions=None):
-    """Use GPT to classify columns as FACTS or DIMENSIONS."""
+def parse_model_yml(yml_path):
+    """Parse model YML file to get column descriptions."""
+    if not yml_path.exists():
+        return {}
 
-    descriptions_section = ""
-    if column_descriptions:
-        descriptions_section = "\n\nColumn descriptions from dbt YML:\n"
-        for col, desc in column_descriptions.items():
-            if col in [c.lower() for c in columns]:
-                descriptions_section += f"- {col}: {desc}\n"
+    return dict(_parse_yml_cached(str(yml_path), yml_path.stat().st_mtime_ns))
+
+def _trim_sql(sql_content, max_sql_chars):
+    """Keep only the last `max_sql_chars` characters of a model's SQL."""
+    if len(sql_content) <= max_sql_chars:
+        return sql_content
+    tail = sql_content[-max_sql_chars:]
+    # Start on a line boundary so no partial statement is shown
+    newline = tail.find('\n')
+    if newline != -1:
+        tail = tail[newline + 1:]
+    return "-- (earlier SQL omitted)\n" + tail
+
+def _descriptions_section(columns, column_descriptions):
+    """Format the YML descriptions of the given columns for a prompt."""
+    if not column_descriptions:
+        return ""
+
+    cols_lc = {c.lower() for c in columns}
+    lines = ''.join(f"- {col}: {desc}\n" for col, desc in column_descriptions.items() if col in cols_lc)
+    return "\n\nColumn descriptions from dbt YML:\n" + lines
+
+def _chat_params(prompt, gpt_model):
+    """Wrap a user prompt in the chat completion parameters used for classification."""
+    return {
+        "model": gpt_model,
+        "messages": [
+            {"role": "system", "content": "You are a data modeling expert specializing in Snowflake Semantic Views."},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.3,
+        "response_format": {"type": "json_object"}
+    }
+
+def build_classification_request(columns, sql_content, source_model_name, column_descriptions=None,
+                                  max_sql_chars=MAX_SQL_CHARS, gpt_model=DEFAULT_GPT_MODEL):
+    """Build the chat completion parameters used to classify columns.
+
+    Only the last `max_sql_chars` characters of the SQL are sent, since the
+    final SELECT sits at the end of a dbt model. This keeps prompt tokens and
+    latency low for large models, at the cost of hiding earlier CTE logic
+    from GPT; the parsed column list is always sent in full.
+    """
+    sql_content = _trim_sql(sql_content, max_sql_chars)
+    descriptions_section = _descriptions_section(columns, column_descriptions)
 
     prompt = f"""
 You are a data modeling expert. Analyze the following dbt SQL model and classify each column as either a FACT or a DIMENSION for a Snowflake Semantic View.
@@ -82,6 +235,7 @@ For each column, provide:
 2. A brief comment describing the column (use English for descriptions)
    - Use the dbt YML descriptions above if available
    - Otherwise infer from the SQL content
+3. Your confidence in the classification (high or low)
 
 Also suggest:
 - Which columns should be the PRIMARY KEY (typically ID + timestamp)
@@ -92,105 +246,429 @@ Return your response in this exact JSON format:
 {{
   "primary_keys": ["col1", "col2"],
   "columns": {{
-    "column_name": {{"type": "FACT/DIMENSION", "comment": "description"}},
+    "column_name": {{"type": "FACT/DIMENSION", "comment": "description", "confidence": "high/low"}},
     ...
   }}
 }}
 """
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are a data modeling expert specializing in Snowflake Semantic Views."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.3,
-        response_format={"type": "json_object"}
-    )
+    return _chat_params(prompt, gpt_model)
+
+def build_multi_classification_request(models, max_sql_chars=MAX_SQL_CHARS, gpt_model=DEFAULT_GPT_MODEL):
+    """Build the chat completion parameters used to classify several models at once."""
+    model_sections = []
+    for model_name, (columns, sql_content, column_descriptions) in models.items():
+        model_sections.append(f"""=== MODEL: {model_name} ===
+SQL Content:
+```sql
+{_trim_sql(sql_content, max_sql_chars)}
+```
+
+Columns to classify:
+{', '.join(columns)}
+{_descriptions_section(columns, column_descriptions)}""")
+    models_text = '\n'.join(model_sections)
+
+    prompt = f"""
+You are a data modeling expert. Analyze each of the following dbt SQL models and classify each of their columns as either a FACT or a DIMENSION for a Snowflake Semantic View.
+
+Guidelines:
+- FACTS: Measures, metrics, timestamps, numeric values that change over time, status codes
+- DIMENSIONS: Attributes used for grouping/filtering like IDs, names, emails, organizational hierarchies
 
-    import json
-    result = json.loads(response.choices[0].message.content)
+{models_text}
+For each column of each model, provide:
+1. Classification (FACT or DIMENSION)
+2. A brief comment describing the column (use English for descriptions)
+   - Use the dbt YML descriptions above if available
+   - Otherwise infer from the SQL content
+3. Your confidence in the classification (high or low)
+
+Also suggest for each model:
+- Which columns should be the PRIMARY KEY (typically ID + timestamp)
+
+Return your response in this exact JSON format, with one entry per model name:
+{{
+  "results": {{
+    "model_name": {{
+      "primary_keys": ["col1", "col2"],
+      "columns": {{
+        "column_name": {{"type": "FACT/DIMENSION", "comment": "description", "confidence": "high/low"}},
+        ...
+      }}
+    }},
+    ...
+  }}
+}}
+"""
+
+    return _chat_params(prompt, gpt_model)
+
+def group_models_for_prompt(models, max_models=MODELS_PER_PROMPT, char_budget=PROMPT_CHAR_BUDGET,
+                            max_sql_chars=MAX_SQL_CHARS):
+    """Split models into groups that fit in one combined classification prompt."""
+    groups = []
+    group, group_size = {}, 0
+    for model_name, (columns, sql_content, column_descriptions) in models.items():
+        size = (min(len(sql_content), max_sql_chars)
+                + sum(len(col) + 2 for col in columns)
+                + sum(len(desc) for desc in (column_descriptions or {}).values()))
+        if group and (len(group) >= max_models or group_size + size > char_budget):
+            groups.append(group)
+            group, group_size = {}, 0
+        group[model_name] = (columns, sql_content, column_descriptions)
+        group_size += size
+    if group:
+        groups.append(group)
+    return groups
+
+def get_cache_path(params):
+    """Return the cache file path for a set of chat completion parameters."""
+    payload = PROMPT_VERSION + json.dumps(params, sort_keys=True, ensure_ascii=False)
+    key = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    return CACHE_DIR / f"{key}.json"
+
+def load_cached_classification(params):
+    """Return the cached classification for these parameters, or None."""
+    cache_path = get_cache_path(params)
+    if not cache_path.exists():
+        return None
+    try:
+        return json.loads(cache_path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        # Treat unreadable or corrupt entries as a miss; they are rewritten on save
+        return None
+
+def save_cached_classification(params, result):
+    """Store a classification in the on-disk cache."""
+    CACHE_DIR.mkdir(exist_ok=True)
+    # Write to a temporary file first so an interrupted run never leaves a partial entry
+    with tempfile.NamedTemporaryFile('w', dir=CACHE_DIR, suffix='.tmp', encoding='utf-8', delete=False) as f:
+        json.dump(result, f, ensure_ascii=False)
+    os.replace(f.name, get_cache_path(params))
+
+async def _request_json(params):
+    """Send a chat completion request and parse the streamed JSON response."""
+    # Back off and retry when the account's rate limit is hit
+    async for attempt in AsyncRetrying(
+        wait=wait_exponential(multiplier=1, max=32),
+        stop=stop_after_attempt(5),
+        retry=retry_if_exception_type(RateLimitError),
+        reraise=True
+    ):
+        with attempt:
+            # Stream the response so it is read while it is being generated
+            stream = await client.chat.completions.create(**params, stream=True)
+            buf = []
+            async for chunk in stream:
+                if chunk.choices:
+                    buf.append(chunk.choices[0].delta.content or "")
+
+    return json.loads(''.join(buf))
+
+def needs_escalation(classification, columns):
+    """Check whether a classification should be redone with the escalation model."""
+    returned = {col.lower(): info for col, info in (classification.get('columns') or {}).items()}
+    for col in columns:
+        col = col.lower()
+        # Parser artifacts like `*`, `int)` or Jinja loop items never come back as column keys
+        if col.startswith('distinct '):
+            col = col[len('distinct '):].strip()
+        if not _IDENTIFIER_RE.fullmatch(col):
+            continue
+        if col not in returned:
+            return True
+    return any(isinstance(info, dict) and info.get('confidence', 'high') == 'low'
+               for info in returned.values())
+
+async def classify_columns_with_gpt(columns, sql_content, source_model_name, column_descriptions=None,
+                                    max_sql_chars=MAX_SQL_CHARS, gpt_model=DEFAULT_GPT_MODEL,
+                                    escalation_model=ESCALATION_GPT_MODEL):
+    """Use GPT to classify columns as FACTS or DIMENSIONS."""
+    params = build_classification_request(columns, sql_content, source_model_name, column_descriptions,
+                                          max_sql_chars, gpt_model)
+
+    cached = load_cached_classification(params)
+    if cached is not None:
+        return cached
+
+    result = await _request_json(params)
+    if escalation_model and escalation_model != gpt_model and needs_escalation(result, columns):
+        return await escalate_classification(columns, sql_content, source_model_name, column_descriptions,
+                                             max_sql_chars, gpt_model, escalation_model)
+
+    save_cached_classification(params, result)
+    return result
+
+async def escalate_classification(columns, sql_content, source_model_name, column_descriptions,
+                                  max_sql_chars, gpt_model, escalation_model):
+    """Classify a model with the escalation model, caching it under the `gpt_model` request."""
+    print(f"    Escalating {source_model_name} to {escalation_model}")
+    result = await _request_json(build_classification_request(
+        columns, sql_content, source_model_name, column_descriptions, max_sql_chars, escalation_model))
+    save_cached_classification(build_classification_request(
+        columns, sql_content, source_model_name, column_descriptions, max_sql_chars, gpt_model), result)
     return result
 
+async def classify_models_with_gpt(models, max_sql_chars=MAX_SQL_CHARS, gpt_model=DEFAULT_GPT_MODEL,
+                                   escalation_model=ESCALATION_GPT_MODEL):
+    """Use one GPT call to classify the columns of several models."""
+    params = build_multi_classification_request(models, max_sql_chars, gpt_model)
+    response = await _request_json(params)
+
+    results = {}
+    uncertain = []
+    for model_name, result in (response.get('results') or {}).items():
+        if model_name not in models or not isinstance(result, dict) or 'columns' not in result:
+            continue
+        columns, sql_content, column_descriptions = models[model_name]
+        if escalation_model and escalation_model != gpt_model and needs_escalation(result, columns):
+            uncertain.append(model_name)
+            continue
+        single_params = build_classification_request(columns, sql_content, model_name, column_descriptions,
+                                                     max_sql_chars, gpt_model)
+        save_cached_classification(single_params, result)
+        results[model_name] = result
+
+    return results, uncertain
+
+async def classify_columns_with_batch(requests):
+    """Classify columns for several models in one OpenAI Batch API job.
+
+    `requests` maps custom id to chat completion parameters. Returns a dict
+    mapping custom id to classification; requests that failed, or did not
+    finish before the batch ended or timed out, are omitted.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.jsonl', encoding='utf-8', delete=False) as f:
+        for custom_id, params in requests.items():
+            line = {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": params
+            }
+            f.write(json.dumps(line) + '\n')
+        batch_input_path = Path(f.name)
+
+    try:
+        with open(batch_input_path, 'rb') as f:
+            batch_input = await client.files.create(file=f, purpose="batch")
+    finally:
+        batch_input_path.unlink()
+
+    batch = await client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"    Submitted batch {batch.id} with {len(requests)} request(s)")
+
+    deadline = time.monotonic() + BATCH_TIMEOUT
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        if time.monotonic() >= deadline:
+            await client.batches.cancel(batch.id)
+            print(f"    Batch {batch.id} did not complete within {BATCH_TIMEOUT} seconds; cancelled")
+            return {}
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        # An expired batch still has output for the requests that did finish
+        print(f"    Batch {batch.id} finished with status '{batch.status}'")
+
+    results = {}
+    if not batch.output_file_id:
+        return results
+
+    output = (await client.files.content(batch.output_file_id)).text
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError:
+            print("    Skipping malformed line in batch output")
+            continue
+        response = item.get('response') or {}
+        if item.get('error') or response.get('status_code') != 200:
+            print(f"    Batch request failed for {item.get('custom_id')}")
+            continue
+        try:
+            content = response['body']['choices'][0]['message']['content']
+            results[item['custom_id']] = json.loads(content)
+        except (KeyError, IndexError, TypeError, json.JSONDecodeError):
+            print(f"    Batch response for {item.get('custom_id')} is not valid JSON")
+
+    return results
+
+def _render_tables(pk_str, ref_model_name):
+    """Render the TABLES section of a semantic view."""
+    pk_line = f"\n    PRIMARY KEY ({pk_str})" if pk_str else ""
+    return f"TABLES (\n  model AS {{{{ ref('{ref_model_name}') }}}}{pk_line}\n)\n"
+
+def _render_facts(facts):
+    """Render the FACTS section; every fact carries a COMMENT."""
+    body = ',\n'.join(
+        f"  model.{name} AS {name}\n    COMMENT = '{info.get('comment', '')}'"
+        for name, info in facts
+    )
+    return f"FACTS (\n{body}\n)\n"
+
+def _render_dims(dimensions):
+    """Render the DIMENSIONS section; empty comments are omitted."""
+    body = ',\n'.join(
+        f"  model.{name} AS {name}"
+        + (f"\n    COMMENT = '{info['comment']}'" if info.get('comment') else "")
+        for name, info in dimensions
+    )
+    return f"DIMENSIONS (\n{body}\n)"
+
 def generate_semantic_view_sql(model_name, classification, ref_model_name):
     """Generate Semantic View SQL based on classification."""
     primary_keys = classification.get('primary_keys', [])
     columns_info = classification.get('columns', {})
 
-    # Build SQL
-    sql_parts = []
-
-    # Config
-    sql_parts.append("{{ config(")
-    sql_parts.append("  materialized = 'semantic_view',")
-    sql_parts.append("  copy_grants = true")
-    sql_parts.append(") }}")
-    sql_parts.append("")
-
-    # TABLES section
-    sql_parts.append("TABLES (")
-    pk_str = ', '.join([col.upper() for col in primary_keys])
-    sql_parts.append(f"  model AS {{{{ ref('{ref_model_name}') }}}}")
-    if pk_str:
-        sql_parts.append(f"    PRIMARY KEY ({pk_str})")
-    sql_parts.append(")")
-    sql_parts.append("")
-
-    # FACTS section
-    facts = [(col, info) for col, info in columns_info.items() if info['type'] == 'FACT']
+    # Uppercase each column name once and reuse it across sections
+    upper = {col: col.upper() for col in columns_info}
+    pk_str = ', '.join(upper.get(col) or col.upper() for col in primary_keys)
+
+    facts = [(upper[col], info) for col, info in columns_info.items() if info['type'] == 'FACT']
+    dimensions = [(upper[col], info) for col, info in columns_info.items() if info['type'] == 'DIMENSION']
+
+    sections = [
+        "{{ config(\n  materialized = 'semantic_view',\n  copy_grants = true\n) }}\n",
+        _render_tables(pk_str, ref_model_name),
+    ]
     if facts:
-        sql_parts.append("FACTS (")
-        for i, (col, info) in enumerate(facts):
-            comment = info.get('comment', '')
-            comma = ',' if i < len(facts) - 1 else ''
-            sql_parts.append(f"  model.{col.upper()} AS {col.upper()}")
-            sql_parts.append(f"    COMMENT = '{comment}'{comma}")
-        sql_parts.append(")")
-        sql_parts.append("")
-
-    # DIMENSIONS section
-    dimensions = [(col, info) for col, info in columns_info.items() if info['type'] == 'DIMENSION']
+        sections.append(_render_facts(facts))
     if dimensions:
-        sql_parts.append("DIMENSIONS (")
-        for i, (col, info) in enumerate(dimensions):
-            comment = info.get('comment', '')
-            comma = ',' if i < len(dimensions) - 1 else ''
-            sql_parts.append(f"  model.{col.upper()} AS {col.upper()}")
-            if comment:
-                sql_parts.append(f"    COMMENT = '{comment}'{comma}")
-            else:
-                sql_parts[-1] += comma
-        sql_parts.append(")")
+        sections.append(_render_dims(dimensions))
 
     # Overall comment
-    sql_parts.append(f"COMMENT = 'Semantic view for {model_name} model. Enables natural language queries via Cortex Analyst'")
+    sections.append(f"COMMENT = 'Semantic view for {model_name} model. Enables natural language queries via Cortex Analyst'")
 
-    return '\n'.join(sql_parts)
+    return '\n'.join(sections)
 
-def get_next_version(models_dir, base_name):
-    """Find the next available version number for a semantic view."""
+def get_latest_semantic_view(models_dir, base_name):
+    """Find the newest existing semantic view file and its version number.
+
+    Returns (0, None) when no semantic view exists yet.
+    """
     # Check for existing semantic view files with version numbers
-    pattern = f"{base_name}_semantic_view*.sql"
-    existing_files = list(models_dir.glob(pattern))
-
-    if not existing_files:
-        return 1
-
-    # Extract version numbers
-    versions = []
-    for f in existing_files:
-        # Match patterns like: model_semantic_view_v2.sql
-        match = re.search(r'_v(\d+)\.sql$', f.name)
-        if match:
-            versions.append(int(match.group(1)))
-        else:
-            # If no version number, treat as v1
-            versions.append(1)
+    prefix = f"{base_name}_semantic_view"
+    unversioned = f"{prefix}.sql"
+
+    # Single pass over the directory, keeping a running maximum
+    latest_version, latest_name = 0, None
+    with os.scandir(models_dir) as entries:
+        for e in entries:
+            name = e.name
+            if not (name.startswith(prefix) and name.endswith('.sql')):
+                continue
+            # The unversioned file is v1; only run the regex on the others
+            if name == unversioned:
+                version = 1
+            else:
+                match = _VERSION_RE.search(name)
+                # If no version number, treat as v1
+                version = int(match.group(1)) if match else 1
+            if version > latest_version:
+                latest_version, latest_name = version, name
 
-    return max(versions) + 1 if versions else 1
+    if latest_name is None:
+        return 0, None
+    return latest_version, models_dir / latest_name
 
-def process_semantic_directory(semantic_dir):
-    """Process a single semantic directory."""
+def get_next_version(models_dir, base_name):
+    """Find the next available version number for a semantic view."""
+    return get_latest_semantic_view(models_dir, base_name)[0] + 1
+
+def compute_fingerprint(sql_file, yml_file, gpt_models=()):
+    """Hash a model's SQL and YML inputs together with PROMPT_VERSION and the GPT models used."""
+    h = hashlib.sha256(PROMPT_VERSION.encode('utf-8'))
+    for gpt_model in gpt_models:
+        h.update(f"\0{gpt_model or ''}".encode('utf-8'))
+    h.update(sql_file.read_bytes())
+    if yml_file.exists():
+        h.update(yml_file.read_bytes())
+    return h.hexdigest()
+
+def load_manifest(output_dir):
+    """Load the fingerprint manifest of a semantic_views directory."""
+    manifest_path = output_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    return json.loads(manifest_path.read_text(encoding='utf-8'))
+
+def save_manifest(output_dir, manifest):
+    """Atomically write the fingerprint manifest of a semantic_views directory."""
+    with tempfile.NamedTemporaryFile('w', dir=output_dir, suffix='.tmp', encoding='utf-8', delete=False) as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(f.name, output_dir / MANIFEST_NAME)
+
+async def classify_models_sync(models, semaphore, gpt_model, escalation_model, semantic_dir,
+                               max_sql_chars=MAX_SQL_CHARS):
+    """Classify models with direct, concurrent chat completion calls."""
+    groups = group_models_for_prompt(models, max_sql_chars=max_sql_chars)
+    print(f"  Analyzing {len(models)} model(s) with {gpt_model} in {len(groups)} request(s), "
+          f"{OPENAI_CONCURRENCY} at a time...")
+
+    # A failed request only drops its own models; the rest of the run carries on
+    async def classify_one(model_name):
+        columns, sql_content, column_descriptions = models[model_name]
+        try:
+            async with semaphore:
+                return {model_name: await classify_columns_with_gpt(
+                    columns, sql_content, model_name, column_descriptions, max_sql_chars,
+                    gpt_model=gpt_model, escalation_model=escalation_model)}
+        except Exception as e:
+            print(f"    Failed to classify {semantic_dir / model_name}: {e}")
+            return {}
+
+    async def escalate_one(model_name):
+        columns, sql_content, column_descriptions = models[model_name]
+        try:
+            async with semaphore:
+                return {model_name: await escalate_classification(
+                    columns, sql_content, model_name, column_descriptions,
+                    max_sql_chars, gpt_model, escalation_model)}
+        except Exception as e:
+            print(f"    Failed to escalate {semantic_dir / model_name}: {e}")
+            return {}
+
+    async def classify_group(group):
+        if len(group) == 1:
+            return await classify_one(next(iter(group))), []
+        try:
+            async with semaphore:
+                return await classify_models_with_gpt(group, max_sql_chars, gpt_model=gpt_model,
+                                                      escalation_model=escalation_model)
+        except Exception as e:
+            print(f"    Failed to classify {', '.join(group)} from {semantic_dir}: {e}")
+            return {}, []
+
+    classifications = {}
+    uncertain = []
+    for results, group_uncertain in await asyncio.gather(*[classify_group(group) for group in groups]):
+        classifications.update(results)
+        uncertain.extend(group_uncertain)
+
+    # Send uncertain results from combined prompts straight to the escalation model
+    for results in await asyncio.gather(*[escalate_one(model_name) for model_name in uncertain]):
+        classifications.update(results)
+
+    # Fall back to one call per model for anything a combined response left out or that failed
+    missing = [model_name for model_name in models if model_name not in classifications]
+    if missing:
+        print(f"  Re-classifying {len(missing)} model(s) from {semantic_dir} individually...")
+        for results in await asyncio.gather(*[classify_one(model_name) for model_name in missing]):
+            classifications.update(results)
+
+    return classifications
+
+def prepare_semantic_directory(semantic_dir, gpt_model=DEFAULT_GPT_MODEL, escalation_model=ESCALATION_GPT_MODEL):
+    """Parse the changed models of a semantic directory and collect their pending GPT requests."""
     print(f"\nProcessing semantic directory: {semantic_dir}")
 
     # Create output directory for semantic views
@@ -198,67 +676,229 @@ def process_semantic_directory(semantic_dir):
     output_dir.mkdir(exist_ok=True)
 
     # Find SQL files in semantic directory (not in semantic_views subdirectory)
-    sql_files = [f for f in semantic_dir.glob('*.sql')
-                 if f.parent == semantic_dir]
+    with os.scandir(semantic_dir) as entries:
+        sql_files = sorted(Path(e.path) for e in entries
+                           if e.name.endswith('.sql') and e.is_file())
 
     if not sql_files:
         print("  No SQL models found in this semantic folder")
-        return
+        return None
 
     print(f"  Found {len(sql_files)} model(s) to analyze")
 
+    manifest = load_manifest(output_dir)
+
+    # Pass 1: parse models and their column descriptions
+    models = {}
+    fingerprints = {}
     for sql_file in sql_files:
+        # Get model name for ref()
+        model_name = sql_file.stem
+        yml_file = sql_file.with_suffix('.yml')
+
+        # Skip everything when inputs are unchanged since the last generated view
+        fingerprint = compute_fingerprint(sql_file, yml_file, (gpt_model, escalation_model))
+        entry = manifest.get(model_name)
+        if entry and entry.get('fingerprint') == fingerprint and (output_dir / entry.get('file', '')).is_file():
+            print(f"  {sql_file.name}: unchanged since {entry['file']}")
+            continue
+        fingerprints[model_name] = fingerprint
+
         print(f"  Processing {sql_file.name}...")
 
         # Parse SQL
         columns, sql_content = parse_sql_file(sql_file)
         print(f"    Found {len(columns)} columns")
 
-        # Get model name for ref()
-        model_name = sql_file.stem
-
         # Check for corresponding YML file
-        yml_file = sql_file.with_suffix('.yml')
         column_descriptions = {}
         if yml_file.exists():
             column_descriptions = parse_model_yml(yml_file)
             print(f"    Loaded {len(column_descriptions)} column descriptions from {yml_file.name}")
 
-        # Classify with GPT
-        print("    Analyzing with GPT-4...")
-        classification = classify_columns_with_gpt(columns, sql_content, model_name, column_descriptions)
+        models[model_name] = (columns, sql_content, column_descriptions)
+
+    if not models:
+        return None
+
+    # Reuse cached classifications; only the remaining models go to GPT
+    classifications = {}
+    pending = {}
+    for model_name, (columns, sql_content, column_descriptions) in models.items():
+        params = build_classification_request(columns, sql_content, model_name, column_descriptions,
+                                              gpt_model=gpt_model)
+        cached = load_cached_classification(params)
+        if cached is not None:
+            classifications[model_name] = cached
+        else:
+            pending[model_name] = params
+
+    if classifications:
+        print(f"  Reusing cached classification for {len(classifications)} model(s)")
+
+    return {
+        'semantic_dir': semantic_dir,
+        'output_dir': output_dir,
+        'manifest': manifest,
+        'models': models,
+        'fingerprints': fingerprints,
+        'classifications': classifications,
+        'pending': pending,
+    }
+
+async def classify_directory_sync(directory, semaphore, gpt_model, escalation_model):
+    """Classify the pending models of a prepared directory with direct API calls."""
+    models = directory['models']
+    directory['classifications'].update(await classify_models_sync(
+        {model_name: models[model_name] for model_name in directory['pending']}, semaphore,
+        gpt_model, escalation_model, directory['semantic_dir']))
+
+async def classify_directories_with_batch(directories, semaphore, gpt_model, escalation_model):
+    """Classify the pending models of all prepared directories in a single Batch API job."""
+    # Model names can repeat across projects, so namespace custom ids by directory
+    requests = {}
+    owners = {}
+    for directory in directories:
+        for model_name, params in directory['pending'].items():
+            custom_id = f"{directory['semantic_dir']}:{model_name}"
+            requests[custom_id] = params
+            owners[custom_id] = (directory, model_name)
+
+    print(f"\nAnalyzing {len(requests)} model(s) from {len(directories)} director(ies) "
+          f"with {gpt_model} via Batch API...")
+    results = await classify_columns_with_batch(requests)
+
+    # Re-classify uncertain or incomplete batch results directly with the escalation model
+    uncertain = []
+    if escalation_model and escalation_model != gpt_model:
+        uncertain = [custom_id for custom_id, result in results.items()
+                     if needs_escalation(result, owners[custom_id][0]['models'][owners[custom_id][1]][0])]
+
+    async def escalate(custom_id):
+        directory, model_name = owners[custom_id]
+        columns, sql_content, column_descriptions = directory['models'][model_name]
+        try:
+            async with semaphore:
+                return custom_id, await escalate_classification(
+                    columns, sql_content, model_name, column_descriptions,
+                    MAX_SQL_CHARS, gpt_model, escalation_model)
+        except Exception as e:
+            # Keep the uncached batch result rather than dropping the model
+            print(f"    Failed to escalate {custom_id}: {e}")
+            return custom_id, results[custom_id]
+
+    for custom_id, result in results.items():
+        if custom_id not in uncertain:
+            save_cached_classification(requests[custom_id], result)
+    results.update(await asyncio.gather(*[escalate(custom_id) for custom_id in uncertain]))
+
+    for custom_id, result in results.items():
+        directory, model_name = owners[custom_id]
+        directory['classifications'][model_name] = result
+
+    # Classify anything the batch did not return with direct API calls
+    async def classify_missing(directory):
+        models = directory['models']
+        missing = {model_name: models[model_name] for model_name in directory['pending']
+                   if model_name not in directory['classifications']}
+        if missing:
+            print(f"  {len(missing)} model(s) from {directory['semantic_dir']} missing from the batch; "
+                  f"falling back to direct API calls")
+            directory['classifications'].update(await classify_models_sync(
+                missing, semaphore, gpt_model, escalation_model, directory['semantic_dir']))
+
+    await asyncio.gather(*[classify_missing(directory) for directory in directories])
+
+def write_semantic_views(directory):
+    """Generate and write the semantic views of a classified directory."""
+    semantic_dir = directory['semantic_dir']
+    output_dir = directory['output_dir']
+    manifest = directory['manifest']
+    fingerprints = directory['fingerprints']
+    classifications = directory['classifications']
+    manifest_changed = False
+
+    # Pass 2: generate and write semantic views
+    for model_name in directory['models']:
+        classification = classifications.get(model_name)
+        if classification is None:
+            print(f"  Skipping {semantic_dir / model_name}.sql: no classification returned")
+            continue
 
         # Generate semantic view
         semantic_view_sql = generate_semantic_view_sql(model_name, classification, model_name)
 
-        # Get next version number
-        version = get_next_version(output_dir, model_name)
+        # Skip writing when the newest existing version is identical
+        latest_version, latest_file = get_latest_semantic_view(output_dir, model_name)
+        if latest_file is not None:
+            existing_content = latest_file.read_text(encoding='utf-8')
+            if existing_content.strip() == semantic_view_sql.strip():
+                print(f"  Semantic view already up to date: {latest_file}")
+                manifest[model_name] = {'fingerprint': fingerprints[model_name], 'file': latest_file.name}
+                manifest_changed = True
+                continue
 
-        # Write semantic view file with version
+        # Write semantic view file with the next version
+        version = latest_version + 1
         if version == 1:
             output_file = output_dir / f"{model_name}_semantic_view.sql"
         else:
             output_file = output_dir / f"{model_name}_semantic_view_v{version}.sql"
 
-        # Check if content has changed (compare with latest version)
-        needs_update = True
-        if version > 1:
-            # Always create new version
-            needs_update = True
-        elif output_file.exists():
-            with open(output_file, 'r', encoding='utf-8') as f:
-                existing_content = f.read()
-            if existing_content.strip() == semantic_view_sql.strip():
-                needs_update = False
-                print(f"    Semantic view already up to date")
+        output_file.write_text(semantic_view_sql, encoding='utf-8')
+        print(f"  Generated {output_file}")
+
+        manifest[model_name] = {'fingerprint': fingerprints[model_name], 'file': output_file.name}
+        manifest_changed = True
+
+    if manifest_changed:
+        save_manifest(output_dir, manifest)
+
+async def process_semantic_directories(semantic_dirs, sync=False, gpt_model=DEFAULT_GPT_MODEL,
+                                       escalation_model=ESCALATION_GPT_MODEL):
+    """Process all semantic directories, classifying their models together."""
+    directories = [directory for directory in
+                   (prepare_semantic_directory(semantic_dir, gpt_model, escalation_model)
+                    for semantic_dir in semantic_dirs)
+                   if directory]
+
+    # One semaphore for all directories keeps OPENAI_CONCURRENCY a global limit
+    semaphore = asyncio.Semaphore(OPENAI_CONCURRENCY)
 
-        if needs_update:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(semantic_view_sql)
-            print(f"    Generated {output_file.name}")
+    # Classify with GPT
+    pending_directories = [directory for directory in directories if directory['pending']]
+    if pending_directories and sync:
+        await asyncio.gather(*[
+            classify_directory_sync(directory, semaphore, gpt_model, escalation_model)
+            for directory in pending_directories
+        ])
+    elif pending_directories:
+        await classify_directories_with_batch(pending_directories, semaphore, gpt_model, escalation_model)
+
+    for directory in directories:
+        write_semantic_views(directory)
 
 def main():
     """Main execution function."""
+    parser = argparse.ArgumentParser(description="Generate Snowflake Semantic Views from dbt models.")
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        help="Classify columns with direct API calls instead of the Batch API (lower latency, higher cost)"
+    )
+    parser.add_argument(
+        '--model',
+        default=DEFAULT_GPT_MODEL,
+        help=f"GPT model used to classify columns (default: {DEFAULT_GPT_MODEL})"
+    )
+    parser.add_argument(
+        '--escalation-model',
+        default=ESCALATION_GPT_MODEL,
+        help=f"GPT model used to re-classify low-confidence or incomplete results "
+             f"(default: {ESCALATION_GPT_MODEL}; pass an empty string to disable)"
+    )
+    args = parser.parse_args()
+
     print("Scanning for semantic folders in models directory...")
 
     models_dir = Path('models')
@@ -278,8 +918,8 @@ def main():
     print(f"Found {len(semantic_dirs)} semantic director(ies)")
 
     # Process each semantic directory
-    for semantic_dir in semantic_dirs:
-        process_semantic_directory(semantic_dir)
+    asyncio.run(process_semantic_directories(semantic_dirs, sync=args.sync, gpt_model=args.model,
+                                             escalation_model=args.escalation_model))
 
     print("\n=== Semantic view generation complete ===")
 